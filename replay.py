@@ -0,0 +1,283 @@
+import socket
+import threading
+import logging
+import json
+import argparse
+import bisect
+import os
+import statistics
+import time
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+
+# Shortest pause between two sends on one connection. The server reads each recv() as one JSON
+# message, so messages sent back to back on the same stream would merge and fail to decode.
+MIN_SEND_GAP = 0.05
+
+def parse_record(line):
+    """Parses one capture line into (timestamp, connection id, event, message), or returns None if it is not a valid record."""
+    try:
+        record = json.loads(line)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(record, list) or len(record) < 3:
+        return None
+    timestamp, connection_id, event = record[:3]
+    message = record[3] if len(record) > 3 else None
+    if not isinstance(timestamp, (int, float)) or event not in ("o", "m", "c"):
+        return None
+    if event == "m" and not isinstance(message, str):
+        return None
+    return timestamp, connection_id, event, message
+
+def load_capture(path):
+    """
+    Reads a capture file written by `server.py --capture`, including its rotated backups.
+    Returns a dict mapping each connection id to its list of (timestamp, event, message) records.
+    Records after a close under the same id are split off as a new connection, with "/<n>" appended to the id.
+    """
+    backups = []
+    index = 1
+    while os.path.exists(f"{path}.{index}"):
+        backups.append(f"{path}.{index}")
+        index += 1
+    # Higher backup numbers hold older records, so read them first
+    files = list(reversed(backups)) + ([path] if os.path.exists(path) else [])
+
+    captured = {}
+    for file_path in files:
+        with open(file_path, encoding='utf-8') as capture_file:
+            for line in capture_file:
+                record = parse_record(line)
+                if record is None:
+                    logging.warning(f"Skipping malformed capture record in {file_path}: {line.strip()}")
+                    continue
+                timestamp, connection_id, event, message = record
+                captured.setdefault(str(connection_id), []).append((timestamp, event, message))
+
+    connections = {}
+    for connection_id, records in captured.items():
+        records.sort(key=lambda record: record[0])
+        session = 0
+        current = []
+        for record in records:
+            current.append(record)
+            if record[1] == "c":
+                connections[connection_id if session == 0 else f"{connection_id}/{session}"] = current
+                session += 1
+                current = []
+        if current:
+            connections[connection_id if session == 0 else f"{connection_id}/{session}"] = current
+    return connections
+
+def scheduled_time(timestamp, start_time, first_timestamp, speed):
+    """Returns the monotonic time at which a record should be replayed, or None at max speed (`speed` 0)."""
+    if not speed:
+        return None
+    return start_time + (timestamp - first_timestamp) / speed
+
+def split_lines(buffer):
+    """
+    Splits received bytes into complete decoded lines and the leftover bytes of an unfinished line.
+    The server sends error replies without a trailing newline, so a leftover that already parses as JSON counts as a line.
+    """
+    lines = buffer.split(b'\n')
+    leftover = lines.pop()
+    if leftover:
+        try:
+            json.loads(leftover)
+        except ValueError:
+            pass
+        else:
+            lines.append(leftover)
+            leftover = b""
+    return [line.decode('utf-8', errors='replace') for line in lines if line.strip()], leftover
+
+def replay_connection(ip, port, records, start_time, first_timestamp, speed, result):
+    """
+    Replays one captured connection against the server, keeping the original inter-arrival timing
+    scaled by `speed` (0 replays as fast as possible). Sends on the same connection are always at least
+    MIN_SEND_GAP apart. Fills `result` with send and receive times.
+    """
+    def wait_until(timestamp):
+        target = scheduled_time(timestamp, start_time, first_timestamp, speed)
+        if target is not None:
+            delay = target - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def receive_responses(client_socket):
+        # Bytes are buffered and decoded a whole line at a time, since recv() can split a multibyte character
+        buffer = b""
+        while True:
+            try:
+                data = client_socket.recv(4096)
+            except OSError:
+                break
+            if not data:
+                break
+            received_at = time.monotonic()
+            lines, buffer = split_lines(buffer + data)
+            for line in lines:
+                result["received"].append((received_at, line))
+        if buffer.strip():
+            result["received"].append((time.monotonic(), buffer.decode('utf-8', errors='replace')))
+        result["server_closed"] = True
+
+    # If the capture rotated mid-connection the first surviving record stands in for the open
+    wait_until(records[0][0])
+
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+        client_socket.connect((ip, port))
+    except OSError as e:
+        result["divergences"].append(f"connect failed: {e}")
+        return
+
+    receiver = threading.Thread(target=receive_responses, args=(client_socket,), daemon=True)
+    receiver.start()
+
+    last_sent_at = None
+    try:
+        for timestamp, event, message in records:
+            if event == "o":
+                continue
+            wait_until(timestamp)
+            if event == "c":
+                break
+            if last_sent_at is not None:
+                gap = last_sent_at + MIN_SEND_GAP - time.monotonic()
+                if gap > 0:
+                    time.sleep(gap)
+            if result["server_closed"]:
+                result["divergences"].append(f"server closed the connection before message {message!r}")
+                break
+            try:
+                last_sent_at = time.monotonic()
+                result["sent"].append((last_sent_at, message))
+                client_socket.sendall(message.encode('utf-8'))
+            except OSError as e:
+                result["divergences"].append(f"send failed for message {message!r}: {e}")
+                break
+        # Give the server a moment to answer the last message before hanging up
+        time.sleep(0.2)
+    finally:
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        client_socket.close()
+        receiver.join(timeout=1)
+
+def collect_latencies(result):
+    """
+    Pairs every sent message with the next line received on the same connection before the following send.
+    That line is not necessarily the message's own reply: it may be a broadcast caused by another connection.
+    Returns the times to next line in seconds and the messages after which nothing was received.
+    """
+    latencies = []
+    unanswered = []
+    # Lines are appended by a single receiver thread, so their times are already sorted
+    received_times = [received_at for received_at, _ in result["received"]]
+    sent = result["sent"]
+    for i, (sent_at, message) in enumerate(sent):
+        next_sent_at = sent[i + 1][0] if i + 1 < len(sent) else float("inf")
+        index = bisect.bisect_left(received_times, sent_at)
+        if index < len(received_times) and received_times[index] < next_sent_at:
+            latencies.append(received_times[index] - sent_at)
+        else:
+            unanswered.append(message)
+    return latencies, unanswered
+
+def replay(ip, port, path, speed=1.0):
+    """
+    Replays a captured trace with one thread per original connection and returns a summary report.
+    `speed` scales the original timing (2.0 is twice as fast); 0 sends everything as fast as possible.
+    Every connection is replayed over raw TCP, including ones captured from the WebSocket gateway.
+    Divergences are what the replay itself observes (server errors, dropped connections, messages followed
+    by silence); only inbound traffic is captured, so the replay is not compared with the original responses.
+    """
+    connections = load_capture(path)
+    if not connections:
+        raise ValueError(f"No capture records found in {path}")
+
+    first_timestamp = min(records[0][0] for records in connections.values())
+    start_time = time.monotonic()
+    results = {}
+    threads = []
+    for connection_id, records in sorted(connections.items()):
+        results[connection_id] = {"sent": [], "received": [], "divergences": [], "server_closed": False}
+        thread = threading.Thread(
+            target=replay_connection,
+            args=(ip, port, records, start_time, first_timestamp, speed, results[connection_id])
+        )
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    latencies = []
+    unanswered = 0
+    divergences = []
+    for connection_id, result in sorted(results.items()):
+        connection_latencies, connection_unanswered = collect_latencies(result)
+        latencies.extend(connection_latencies)
+        unanswered += len(connection_unanswered)
+        divergences.extend(f"connection {connection_id}: {divergence}" for divergence in result["divergences"])
+        divergences.extend(f"connection {connection_id}: nothing received after message {message!r}"
+                           for message in connection_unanswered)
+        for _, line in result["received"]:
+            try:
+                response = json.loads(line)
+            except json.JSONDecodeError:
+                divergences.append(f"connection {connection_id}: malformed response {line!r}")
+                continue
+            if isinstance(response, dict) and response.get("type") == "error":
+                divergences.append(f"connection {connection_id}: server error {response.get('message')!r}")
+
+    return {
+        "connections": len(connections),
+        "websocket_connections": sum(1 for records in connections.values()
+                                     if records[0][1] == "o" and records[0][2] == "websocket"),
+        "messages": sum(len(result["sent"]) for result in results.values()),
+        "unanswered": unanswered,
+        "divergences": divergences,
+        "latencies": latencies,
+        "duration": time.monotonic() - start_time
+    }
+
+def print_report(report):
+    """Prints a replay summary with time-to-next-line percentiles in milliseconds."""
+    print(f"Replayed {report['messages']} messages over {report['connections']} connections in {report['duration']:.2f}s")
+    if report["websocket_connections"]:
+        print(f"{report['websocket_connections']} WebSocket connections were replayed over TCP, "
+              "without WebSocket framing or compression")
+    latencies = sorted(report["latencies"])
+    if latencies:
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        print(f"Time to next line received, ms: min {latencies[0] * 1000:.2f}, median {statistics.median(latencies) * 1000:.2f}, "
+              f"p95 {p95 * 1000:.2f}, max {latencies[-1] * 1000:.2f}")
+    print(f"Messages without a response: {report['unanswered']}")
+    print(f"Divergences: {len(report['divergences'])}")
+    for divergence in report["divergences"]:
+        print(f"  {divergence}")
+
+def parse_speed(value):
+    """Parses the --speed argument, where "max" means no delay between messages."""
+    if value == "max":
+        return 0.0
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive or 'max'")
+    return speed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay traffic captured with server.py --capture")
+    parser.add_argument("capture", help="Capture file written by server.py --capture")
+    parser.add_argument("-i", "--ip", default="127.0.0.1", help="Server IP address")
+    parser.add_argument("-p", "--port", type=int, required=True, help="Server port")
+    parser.add_argument("-s", "--speed", type=parse_speed, default=1.0, help="Replay speed multiplier, or 'max'")
+    args = parser.parse_args()
+    print_report(replay(args.ip, args.port, args.capture, args.speed))
@@ -1,8 +1,14 @@
 import socket
 import threading
 import logging
+import logging.handlers
 import json
 import argparse
+import itertools
+import os
+import queue
+import time
+from websocket_protocol import BroadcastFrames, WebSocketConnection, WebSocketError, server_handshake
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 
@@ -14,6 +20,12 @@ game_state = {
     "turn": None,
     "players": []
 }
+# Traffic capture for replay.py, only set up when the server is started with --capture
+capture_logger = None
+capture_listener = None
+# Prefixes connection ids so runs appended to the same capture file never share an id
+capture_run_id = None
+connection_ids = itertools.count(1)
 
 def check_winner():
     """
@@ -68,12 +80,19 @@ def broadcast_game_state():
     broadcast_message(game_state_message)
 
 def broadcast_message(message, exclude_client=None):
-    """Sends a message to all connected clients.Removes any disconnected clients."""
+    """
+    Sends a message to all connected clients.Removes any disconnected clients.
+    The message is encoded once per transport and the same bytes are sent to every client.
+    """
+    frames = BroadcastFrames(message)
     disconnected_clients = []
-    for client_socket in clients:
+    for client_socket in list(clients):
         if client_socket != exclude_client:
             try:
-                client_socket.send((message + '\n').encode('utf-8'))
+                if isinstance(client_socket, WebSocketConnection):
+                    client_socket.send_frame(frames.websocket(client_socket.deflate))
+                else:
+                    client_socket.send(frames.tcp)
             except Exception:
                 disconnected_clients.append(client_socket)
 
@@ -81,10 +100,56 @@ def broadcast_message(message, exclude_client=None):
         if client_socket in clients:
             del clients[client_socket]
 
+def enable_capture(path, max_bytes=10 * 1024 * 1024, backup_count=5):
+    """
+    Starts recording inbound traffic to a rotating capture file.
+    Records are written by a background listener so client threads only pay for a queue put.
+    """
+    global capture_logger, capture_listener, capture_run_id
+    capture_run_id = f"{os.getpid()}-{time.time_ns()}"
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    record_queue = queue.SimpleQueue()
+    capture_listener = logging.handlers.QueueListener(record_queue, handler)
+    capture_listener.start()
+
+    capture_logger = logging.getLogger("capture")
+    capture_logger.propagate = False
+    capture_logger.setLevel(logging.INFO)
+    capture_logger.addHandler(logging.handlers.QueueHandler(record_queue))
+    logging.info(f"Capturing inbound traffic to {path}")
+
+def disable_capture():
+    """Stops the capture listener, flushing any records still queued to the capture file."""
+    global capture_logger, capture_listener
+    if capture_listener:
+        capture_listener.stop()
+        for handler in capture_listener.handlers:
+            handler.close()
+    if capture_logger:
+        capture_logger.handlers.clear()
+    capture_logger = None
+    capture_listener = None
+
+def capture_event(connection_id, event, message=None):
+    """
+    Appends one compact JSON record to the capture file if capture is enabled.
+    Events are "o" (connection opened, with the transport "tcp" or "websocket"), "m" (message received)
+    and "c" (connection closed).
+    """
+    if capture_logger is None:
+        return
+    record = [round(time.time(), 6), f"{capture_run_id}-{connection_id}", event]
+    if message is not None:
+        record.append(message)
+    capture_logger.info(json.dumps(record, separators=(',', ':')))
+
 def client_connection(client_socket, client_address):
     """Handles communication with a single client, including receiving and processing messages."""
     logging.info(f"Connection established with {client_address}")
     clients[client_socket] = {"address": client_address, "username": None, "id": len(clients)}
+    connection_id = next(connection_ids)
+    capture_event(connection_id, "o", "tcp")
 
     try:
         while True:
@@ -93,6 +158,7 @@ def client_connection(client_socket, client_address):
                 if not message:
                     logging.warning(f"Empty message received from {client_address}")
                     break
+                capture_event(connection_id, "m", message)
                 handle_message(client_socket, message)
             except json.JSONDecodeError:
                 logging.error(f"Malformed message from {client_address}: {message}")
@@ -103,9 +169,60 @@ def client_connection(client_socket, client_address):
     except (ConnectionResetError, OSError):
         logging.error(f"Connection lost with {client_address}")
     finally:
+        capture_event(connection_id, "c")
         handle_quit(client_socket)
         client_socket.close()
 
+def websocket_connection(client_socket, client_address):
+    """
+    Handles a single WebSocket client. After the handshake the connection is registered in `clients`
+    like a TCP socket, so it shares the same message handlers and broadcasts.
+    """
+    try:
+        connection = server_handshake(client_socket)
+    except (WebSocketError, OSError) as e:
+        logging.error(f"WebSocket handshake failed with {client_address}: {e}")
+        client_socket.close()
+        return
+
+    logging.info(f"WebSocket connection established with {client_address}")
+    clients[connection] = {"address": client_address, "username": None, "id": len(clients)}
+    connection_id = next(connection_ids)
+    capture_event(connection_id, "o", "websocket")
+
+    try:
+        while True:
+            try:
+                message = connection.receive()
+                if message is None:
+                    logging.info(f"WebSocket client {client_address} closed the connection")
+                    break
+                capture_event(connection_id, "m", message)
+                handle_message(connection, message)
+            except WebSocketError as e:
+                logging.error(f"WebSocket protocol error with {client_address}: {e}")
+                connection.close(1002)
+                break
+            except UnicodeDecodeError:
+                logging.error(f"Invalid UTF-8 in WebSocket message from {client_address}")
+                connection.close(1007)
+                break
+            except Exception as e:
+                logging.error(f"Unexpected error with {client_address}: {e}")
+                break
+    except (ConnectionResetError, OSError):
+        logging.error(f"Connection lost with {client_address}")
+    finally:
+        capture_event(connection_id, "c")
+        handle_quit(connection)
+        connection.close()
+
+def websocket_listener(server):
+    """Accepts WebSocket clients on their own, already bound, port alongside the TCP listener."""
+    while True:
+        client_socket, client_address = server.accept()
+        threading.Thread(target=websocket_connection, args=(client_socket, client_address), daemon=True).start()
+
 def handle_message(client_socket, message):
     """Handles message from a client by identifying its type and taking appropriate action."""
     try:
@@ -233,13 +350,28 @@ def server_startup():
     """Starts the server, listens for incoming connections, and spawns threads to handle clients."""
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", "--port", type=int, required=True, help="Port to run the server on")
+    parser.add_argument("-w", "--ws-port", type=int, help="Also accept WebSocket clients on this port")
+    parser.add_argument("--capture", help="Record inbound traffic to this file for replay.py")
+    parser.add_argument("--capture-max-bytes", type=int, default=10 * 1024 * 1024, help="Size at which the capture file is rotated")
+    parser.add_argument("--capture-backups", type=int, default=5, help="Number of rotated capture files to keep")
     args = parser.parse_args()
 
+    if args.capture:
+        enable_capture(args.capture, args.capture_max_bytes, args.capture_backups)
+
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.bind(('0.0.0.0', args.port))
     server.listen(5)
     logging.info(f"Server started on 0.0.0.0:{args.port}")
 
+    # Bind here rather than in the listener thread so a bad --ws-port stops startup
+    if args.ws_port:
+        websocket_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        websocket_server.bind(('0.0.0.0', args.ws_port))
+        websocket_server.listen(5)
+        logging.info(f"WebSocket server started on 0.0.0.0:{args.ws_port}")
+        threading.Thread(target=websocket_listener, args=(websocket_server,), daemon=True).start()
+
     while True:
         try:
             client_socket, client_address = server.accept()
@@ -249,6 +381,7 @@ def server_startup():
             break
 
     server.close()
+    disable_capture()
 
 if __name__ == "__main__":
     server_startup()
@@ -1,9 +1,15 @@
+import argparse
 import json
 import socket
+import struct
+import zlib
 import threading
 import pytest
 import time
+import server
 from server import server_startup
+from replay import collect_latencies, load_capture, parse_speed, scheduled_time, split_lines
+from websocket_protocol import BroadcastFrames, WebSocketError, accept_key, negotiate_deflate, server_handshake
 
 # Helper function to start the server in a thread
 def start_test_server():
@@ -114,4 +120,275 @@ def test_invalid_json_message(test_server):
         response = client.recv(1024).decode('utf-8')
         assert "Invalid message format" in response
     finally:
-        client.close()
\ No newline at end of file
+        client.close()
+
+# Test that replay reads rotated capture files oldest first and groups records per connection
+def test_load_capture_with_rotation(tmp_path):
+    capture = tmp_path / "capture.log"
+    (tmp_path / "capture.log.2").write_text('[1.0,"run-1","o"]\n[1.5,"run-1","m","{\\"type\\": \\"join\\"}"]\n')
+    (tmp_path / "capture.log.1").write_text('[2.0,"run-2","o"]\n[2.5,"run-1","c"]\n{"not": "a list"}\n[3]\n')
+    capture.write_text('[3.0,"run-2","m","hi"]\nnot a record\n[3.5,"run-2","c"]\n')
+
+    connections = load_capture(str(capture))
+    assert connections["run-1"] == [(1.0, "o", None), (1.5, "m", '{"type": "join"}'), (2.5, "c", None)]
+    assert connections["run-2"] == [(2.0, "o", None), (3.0, "m", "hi"), (3.5, "c", None)]
+
+# Test that records reusing an id after a close are replayed as a new connection
+def test_load_capture_splits_reused_ids(tmp_path):
+    capture = tmp_path / "capture.log"
+    capture.write_text('[1.0,1,"o"]\n[1.5,1,"m","a"]\n[2.0,1,"c"]\n[5.0,1,"o"]\n[5.5,1,"m","b"]\n[6.0,1,"c"]\n')
+
+    connections = load_capture(str(capture))
+    assert connections["1"] == [(1.0, "o", None), (1.5, "m", "a"), (2.0, "c", None)]
+    assert connections["1/1"] == [(5.0, "o", None), (5.5, "m", "b"), (6.0, "c", None)]
+
+# Test that what the server captures is read back by replay, including the run prefix and transport
+def test_capture_round_trip(tmp_path):
+    capture = tmp_path / "capture.log"
+    server.enable_capture(str(capture))
+    try:
+        server.capture_event(1, "o", "tcp")
+        server.capture_event(1, "m", json.dumps({"type": "chat", "message": "héllo"}))
+        server.capture_event(2, "o", "websocket")
+        server.capture_event(1, "c")
+        run_id = server.capture_run_id
+    finally:
+        # Records are only guaranteed to be on disk once the listener has been stopped
+        server.disable_capture()
+
+    connections = load_capture(str(capture))
+    assert sorted(connections) == [f"{run_id}-1", f"{run_id}-2"]
+    tcp_records = connections[f"{run_id}-1"]
+    assert [event for _, event, _ in tcp_records] == ["o", "m", "c"]
+    assert tcp_records[0][2] == "tcp"
+    assert json.loads(tcp_records[1][2])["message"] == "héllo"
+    assert connections[f"{run_id}-2"][0][1:] == ("o", "websocket")
+
+# Test that each send is paired with the next line received before the following send
+def test_collect_latencies():
+    result = {
+        "sent": [(1.0, "join"), (2.0, "move"), (3.0, "chat")],
+        "received": [(0.5, "before"), (1.25, "update"), (1.5, "update"), (3.5, "chat")]
+    }
+    latencies, unanswered = collect_latencies(result)
+    assert latencies == [0.25, 0.5]
+    assert unanswered == ["move"]
+
+# Test replay speed parsing and the scaling of capture timestamps
+def test_replay_speed():
+    assert parse_speed("max") == 0.0
+    assert parse_speed("2") == 2.0
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_speed("0")
+    assert scheduled_time(110.0, 5.0, 100.0, 1.0) == 15.0
+    assert scheduled_time(110.0, 5.0, 100.0, 4.0) == 7.5
+    assert scheduled_time(110.0, 5.0, 100.0, 0.0) is None
+
+# Test that replay only decodes whole lines and keeps partial lines for the next chunk
+def test_split_lines():
+    line = json.dumps({"type": "chat", "message": "é }"}, ensure_ascii=False).encode('utf-8')
+    cut = line.index("é".encode('utf-8')) + 1
+    lines, leftover = split_lines(line[:cut])
+    assert lines == [] and leftover == line[:cut]
+    lines, leftover = split_lines(line[:line.index(b"}") + 1])
+    assert lines == []
+    lines, leftover = split_lines(line + b"\n" + b'{"type": "error", "message": "x"}')
+    assert lines == [line.decode('utf-8'), '{"type": "error", "message": "x"}'] and leftover == b""
+
+# Test that broadcast frames are encoded once and decompress without any shared client context
+def test_websocket_broadcast_frames():
+    message = json.dumps({"type": "chat", "message": "hello " * 20})
+    frames = BroadcastFrames(message)
+    assert frames.tcp == (message + '\n').encode('utf-8')
+    assert frames.websocket(True) is frames.websocket(True)
+
+    frame = frames.websocket(True)
+    assert frame[0] == 0xC1  # FIN, RSV1 (compressed) and text opcode
+    payload = frame[4:] if frame[1] == 126 else frame[2:]
+    assert zlib.decompressobj(-15).decompress(payload + b'\x00\x00\xff\xff').decode('utf-8') == message
+
+    assert negotiate_deflate("permessage-deflate; client_max_window_bits") == \
+        ("permessage-deflate; server_no_context_takeover", False)
+    assert negotiate_deflate("permessage-deflate; server_max_window_bits=10") is None
+    assert negotiate_deflate("permessage-deflate; client_max_window_bits=abc") is None
+    assert negotiate_deflate("permessage-deflate; client_max_window_bits=16") is None
+    assert negotiate_deflate("permessage-deflate; client_no_context_takeover; client_no_context_takeover") is None
+    assert negotiate_deflate("permessage-deflate; client_max_window_bits=abc, permessage-deflate; client_max_window_bits=9") == \
+        ("permessage-deflate; server_no_context_takeover", False)
+
+# Helper function to build a masked client frame
+def client_frame(payload, opcode=0x1, fin=True, rsv1=False, masked=True):
+    first_byte = (0x80 if fin else 0) | (0x40 if rsv1 else 0) | opcode
+    mask = b"\x12\x34\x56\x78" if masked else b""
+    masked_payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload)) if masked else payload
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', first_byte, (0x80 if masked else 0) | length)
+    else:
+        header = struct.pack('!BBH', first_byte, (0x80 if masked else 0) | 126, length)
+    return header + mask + masked_payload
+
+# Helper function to open a WebSocket over a socketpair and return (server connection, client socket)
+def open_websocket(extensions=None):
+    server_socket, client_socket = socket.socketpair()
+    request = ("GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+               "Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n")
+    if extensions:
+        request += f"Sec-WebSocket-Extensions: {extensions}\r\n"
+    client_socket.sendall((request + "\r\n").encode('ascii'))
+    connection = server_handshake(server_socket)
+    response = client_socket.recv(4096).decode('ascii')
+    assert response.startswith("HTTP/1.1 101")
+    assert accept_key("dGhlIHNhbXBsZSBub25jZQ==") in response
+    return connection, client_socket
+
+# Test that masked, compressed and fragmented client messages are decoded, keeping the client's compression context
+def test_websocket_receive_compressed_fragmented():
+    connection, client = open_websocket("permessage-deflate")
+    try:
+        assert connection.deflate and not connection.client_no_context_takeover
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        first = json.dumps({"type": "chat", "message": "hello hello hello"}).encode('utf-8')
+        second = json.dumps({"type": "chat", "message": "hello hello hello!"}).encode('utf-8')
+
+        data = (compressor.compress(first) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+        client.sendall(client_frame(data[:5], fin=False, rsv1=True))
+        client.sendall(client_frame(b"are you there", opcode=0x9))
+        client.sendall(client_frame(data[5:], opcode=0x0))
+        assert connection.receive() == first.decode('utf-8')
+        assert client.recv(1024) == b"\x8a\x0dare you there"
+
+        # The second message refers back to the first through the shared deflate window
+        data = (compressor.compress(second) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+        client.sendall(client_frame(data, rsv1=True))
+        assert connection.receive() == second.decode('utf-8')
+
+        client.sendall(client_frame(struct.pack('!H', 1000), opcode=0x8))
+        assert connection.receive() is None
+    finally:
+        client.close()
+
+# Test that client_no_context_takeover resets the decompressor for every message
+def test_websocket_receive_no_context_takeover():
+    connection, client = open_websocket("permessage-deflate; client_no_context_takeover")
+    try:
+        assert connection.client_no_context_takeover
+        for message in ("hello hello hello", "hello hello hello"):
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+            data = (compressor.compress(message.encode('utf-8')) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+            client.sendall(client_frame(data, rsv1=True))
+            assert connection.receive() == message
+    finally:
+        connection.close()
+        client.close()
+
+# Test that frames breaking RFC 6455 are rejected
+@pytest.mark.parametrize("frame", [
+    client_frame(b"hello", masked=False),
+    client_frame(b"ping", opcode=0x9, fin=False),
+    client_frame(b"x" * 126, opcode=0x9),
+    client_frame(b"hello", rsv1=True),
+    bytes([0xA1]) + client_frame(b"hello")[1:],
+])
+def test_websocket_receive_rejects_invalid_frames(frame):
+    connection, client = open_websocket()
+    try:
+        client.sendall(frame)
+        with pytest.raises(WebSocketError):
+            connection.receive()
+    finally:
+        connection.close()
+        client.close()
+
+# Test that a compressed message inflating past the size limit is rejected
+def test_websocket_receive_rejects_oversized_inflate():
+    connection, client = open_websocket("permessage-deflate")
+    try:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        data = (compressor.compress(b"a" * 100000) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+        client.sendall(client_frame(data, rsv1=True))
+        with pytest.raises(WebSocketError):
+            connection.receive()
+    finally:
+        connection.close()
+        client.close()
+
+# Test that text messages which are not valid UTF-8 are reported to the caller
+def test_websocket_receive_invalid_utf8():
+    connection, client = open_websocket()
+    try:
+        client.sendall(client_frame(b"\xff\xfe"))
+        with pytest.raises(UnicodeDecodeError):
+            connection.receive()
+    finally:
+        connection.close()
+        client.close()
+
+# Test that a client asking for another WebSocket version is told which version to use
+def test_websocket_handshake_unsupported_version():
+    server_socket, client_socket = socket.socketpair()
+    try:
+        client_socket.sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                              b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 8\r\n\r\n")
+        with pytest.raises(WebSocketError):
+            server_handshake(server_socket)
+        response = client_socket.recv(4096).decode('ascii')
+        assert response.startswith("HTTP/1.1 426 Upgrade Required")
+        assert "Sec-WebSocket-Version: 13" in response
+    finally:
+        server_socket.close()
+        client_socket.close()
+
+# Helper function to read one unmasked server frame and return (compressed, text)
+def read_server_frame(client_socket):
+    first_byte, length = client_socket.recv(2, socket.MSG_WAITALL)
+    if length == 126:
+        length = struct.unpack('!H', client_socket.recv(2, socket.MSG_WAITALL))[0]
+    payload = client_socket.recv(length, socket.MSG_WAITALL)
+    compressed = bool(first_byte & 0x40)
+    if compressed:
+        payload = zlib.decompressobj(-15).decompress(payload + b"\x00\x00\xff\xff")
+    return compressed, payload.decode('utf-8')
+
+# Test that WebSocket and TCP clients join the same game and share the same pre-encoded broadcast frames
+def test_websocket_and_tcp_clients_share_game():
+    first_ws, first_ws_client = open_websocket("permessage-deflate")
+    second_ws, second_ws_client = open_websocket("permessage-deflate; client_no_context_takeover")
+    tcp_server, tcp_client = socket.socketpair()
+    sent_frames = {first_ws: [], second_ws: []}
+
+    def record_frames(connection):
+        send_frame = connection.send_frame
+
+        def recording_send_frame(frame):
+            sent_frames[connection].append(frame)
+            send_frame(frame)
+        connection.send_frame = recording_send_frame
+
+    record_frames(first_ws)
+    record_frames(second_ws)
+    try:
+        for client_socket in (first_ws, second_ws, tcp_server):
+            server.clients[client_socket] = {"address": None, "username": None, "id": len(server.clients)}
+        server.handle_message(first_ws, json.dumps({"type": "join", "username": "Web"}))
+        server.handle_message(tcp_server, json.dumps({"type": "join", "username": "Tcp"}))
+        assert server.game_state["players"] == ["Web", "Tcp"]
+
+        chat = "hello from the browser " * 10
+        server.handle_message(first_ws, json.dumps({"type": "chat", "message": chat}))
+        expected = {"type": "chat", "message": f"Web: {chat}"}
+
+        tcp_lines = tcp_client.recv(65536).decode('utf-8').strip().split('\n')
+        assert json.loads(tcp_lines[-1]) == expected
+        for ws_client in (first_ws_client, second_ws_client):
+            frames = [read_server_frame(ws_client) for _ in range(5)]
+            assert [json.loads(text)["type"] for _, text in frames] == ["join", "update", "join", "update", "chat"]
+            assert frames[-1] == (True, json.dumps(expected))
+        # Both WebSocket clients were sent the very same compressed frame object
+        assert sent_frames[first_ws][-1] is sent_frames[second_ws][-1]
+    finally:
+        server.clients.clear()
+        server.game_state["players"].clear()
+        server.reset_game_state()
+        for client_socket in (first_ws, second_ws, tcp_server, first_ws_client, second_ws_client, tcp_client):
+            client_socket.close()
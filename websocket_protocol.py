@@ -0,0 +1,274 @@
+import base64
+import hashlib
+import struct
+import threading
+import zlib
+
+# RFC 6455 constants
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+# Largest message accepted from a client, after decompression
+MAX_MESSAGE_SIZE = 64 * 1024
+DEFLATE_TAIL = b'\x00\x00\xff\xff'
+
+class WebSocketError(Exception):
+    """Raised when a client breaks the WebSocket protocol."""
+
+def encode_frame(payload, opcode=OPCODE_TEXT, compressed=False):
+    """Builds a single unmasked server-to-client frame with the FIN bit set."""
+    first_byte = 0x80 | opcode
+    if compressed:
+        first_byte |= 0x40
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', first_byte, length)
+    elif length < 65536:
+        header = struct.pack('!BBH', first_byte, 126, length)
+    else:
+        header = struct.pack('!BBQ', first_byte, 127, length)
+    return header + payload
+
+def deflate_message(payload):
+    """
+    Compresses one message for permessage-deflate without context takeover.
+    Every message starts from a fresh context, so the result can be sent to any client.
+    """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data[:-4] if data.endswith(DEFLATE_TAIL) else data
+
+def encode_message(payload, deflate=False):
+    """
+    Builds the frame for one text message, compressing it when the client negotiated permessage-deflate.
+    Small messages can grow under deflate, so they are only compressed when it pays off.
+    """
+    if deflate:
+        compressed = deflate_message(payload)
+        if len(compressed) < len(payload):
+            return encode_frame(compressed, compressed=True)
+    return encode_frame(payload)
+
+class BroadcastFrames:
+    """
+    Encodes a broadcast message once and hands out the same bytes to every client.
+    Each representation is built the first time a client needs it.
+    """
+    def __init__(self, message):
+        self.payload = message.encode('utf-8')
+        self.tcp = self.payload + b'\n'
+        self._websocket_frames = {}
+
+    def websocket(self, deflate):
+        """Returns the pre-encoded WebSocket frame, compressed if the client negotiated it."""
+        if deflate not in self._websocket_frames:
+            self._websocket_frames[deflate] = encode_message(self.payload, deflate)
+        return self._websocket_frames[deflate]
+
+def negotiate_deflate(header):
+    """
+    Picks a permessage-deflate offer from a Sec-WebSocket-Extensions header.
+    Returns (response header value, client_no_context_takeover) or None if no offer is acceptable.
+    The server always compresses without context takeover so broadcast frames can be shared between clients.
+    """
+    for offer in header.split(','):
+        params = [param.strip() for param in offer.split(';')]
+        if params[0].lower() != "permessage-deflate":
+            continue
+        offered = {}
+        valid = True
+        for param in params[1:]:
+            name, separator, value = param.partition('=')
+            name = name.strip().lower()
+            value = value.strip().strip('"') if separator else None
+            # RFC 7692 requires declining offers with unknown, duplicated or invalid parameters
+            if name in offered:
+                valid = False
+            elif name == "client_max_window_bits":
+                valid = value is None or (value.isdigit() and 8 <= int(value) <= 15)
+            elif name in ("client_no_context_takeover", "server_no_context_takeover"):
+                valid = value is None
+            else:
+                # Shared frames are compressed with a 15-bit window, so a server_max_window_bits limit cannot be honored
+                valid = False
+            if not valid:
+                break
+            offered[name] = value
+        if not valid:
+            continue
+        response = ["permessage-deflate", "server_no_context_takeover"]
+        client_no_context_takeover = "client_no_context_takeover" in offered
+        if client_no_context_takeover:
+            response.append("client_no_context_takeover")
+        return "; ".join(response), client_no_context_takeover
+    return None
+
+def read_http_request(client_socket):
+    """Reads an HTTP request head from the socket and returns (request line, headers dict)."""
+    data = b""
+    while b"\r\n\r\n" not in data:
+        chunk = client_socket.recv(1024)
+        if not chunk:
+            raise WebSocketError("Connection closed during handshake")
+        data += chunk
+        if len(data) > 8192:
+            raise WebSocketError("Handshake request too large")
+    lines = data.split(b"\r\n\r\n", 1)[0].decode('latin-1').split("\r\n")
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    return lines[0], headers
+
+def accept_key(key):
+    """Computes the Sec-WebSocket-Accept value for a client's Sec-WebSocket-Key."""
+    return base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode('ascii')).digest()).decode('ascii')
+
+def server_handshake(client_socket):
+    """
+    Performs the server side of the WebSocket opening handshake.
+    Returns a WebSocketConnection, or raises WebSocketError after answering with 400 Bad Request,
+    or 426 Upgrade Required if the client asked for a WebSocket version other than 13.
+    """
+    request_line, headers = read_http_request(client_socket)
+    key = headers.get("sec-websocket-key")
+    if not request_line.startswith("GET ") or headers.get("upgrade", "").lower() != "websocket" \
+            or "upgrade" not in headers.get("connection", "").lower() or not key:
+        client_socket.sendall(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        raise WebSocketError(f"Invalid handshake request: {request_line}")
+    if headers.get("sec-websocket-version") != "13":
+        client_socket.sendall(b"HTTP/1.1 426 Upgrade Required\r\nSec-WebSocket-Version: 13\r\n"
+                              b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+        raise WebSocketError(f"Unsupported WebSocket version: {headers.get('sec-websocket-version')}")
+
+    response = [
+        "HTTP/1.1 101 Switching Protocols",
+        "Upgrade: websocket",
+        "Connection: Upgrade",
+        f"Sec-WebSocket-Accept: {accept_key(key)}"
+    ]
+    deflate = negotiate_deflate(headers.get("sec-websocket-extensions", ""))
+    if deflate:
+        response.append(f"Sec-WebSocket-Extensions: {deflate[0]}")
+    client_socket.sendall(("\r\n".join(response) + "\r\n\r\n").encode('ascii'))
+    return WebSocketConnection(client_socket, deflate is not None, deflate[1] if deflate else False)
+
+class WebSocketConnection:
+    """
+    Wraps a client socket after the handshake so the game handlers can treat it like a TCP socket.
+    `send` takes the same UTF-8 bytes the handlers pass to a raw socket and delivers them as one text message.
+    """
+    def __init__(self, client_socket, deflate=False, client_no_context_takeover=False):
+        self.socket = client_socket
+        self.deflate = deflate
+        self.client_no_context_takeover = client_no_context_takeover
+        self.decompressor = zlib.decompressobj(-15)
+        self.send_lock = threading.Lock()
+        self.closed = False
+
+    def send_frame(self, frame):
+        """Sends an already encoded frame; frames from different threads never interleave."""
+        with self.send_lock:
+            self.socket.sendall(frame)
+
+    def send(self, data):
+        """Sends UTF-8 encoded bytes as a single text message."""
+        self.send_frame(encode_message(data, self.deflate))
+        return len(data)
+
+    def close(self, code=1000):
+        """Sends a close frame, if the socket is still open, and closes the socket."""
+        if not self.closed:
+            self.closed = True
+            try:
+                self.send_frame(encode_frame(struct.pack('!H', code), OPCODE_CLOSE))
+            except OSError:
+                pass
+        self.socket.close()
+
+    def _recv_exact(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.socket.recv(size - len(data))
+            if not chunk:
+                raise ConnectionResetError("Connection closed mid-frame")
+            data += chunk
+        return data
+
+    def _read_frame(self):
+        first_byte, second_byte = self._recv_exact(2)
+        fin = bool(first_byte & 0x80)
+        rsv1 = bool(first_byte & 0x40)
+        opcode = first_byte & 0x0F
+        if first_byte & 0x30:
+            raise WebSocketError("RSV2 and RSV3 must be clear")
+        if opcode not in (OPCODE_CONTINUATION, OPCODE_TEXT, OPCODE_BINARY, OPCODE_CLOSE, OPCODE_PING, OPCODE_PONG):
+            raise WebSocketError(f"Unknown opcode {opcode}")
+        if rsv1 and opcode not in (OPCODE_TEXT, OPCODE_BINARY):
+            raise WebSocketError("RSV1 is only allowed on the first frame of a data message")
+        if not second_byte & 0x80:
+            raise WebSocketError("Client frames must be masked")
+        length = second_byte & 0x7F
+        if opcode >= OPCODE_CLOSE and (not fin or length > 125):
+            raise WebSocketError("Control frames must not be fragmented or longer than 125 bytes")
+        if length == 126:
+            length = struct.unpack('!H', self._recv_exact(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self._recv_exact(8))[0]
+        if length > MAX_MESSAGE_SIZE:
+            raise WebSocketError("Frame too large")
+        mask = self._recv_exact(4)
+        payload = self._recv_exact(length)
+        # Unmask the whole payload in one XOR over big integers instead of byte by byte
+        key = (mask * (length // 4 + 1))[:length]
+        payload = (int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')).to_bytes(length, 'big')
+        return fin, rsv1, opcode, payload
+
+    def _inflate(self, payload):
+        if self.client_no_context_takeover:
+            self.decompressor = zlib.decompressobj(-15)
+        data = self.decompressor.decompress(payload + DEFLATE_TAIL, MAX_MESSAGE_SIZE + 1)
+        if len(data) > MAX_MESSAGE_SIZE or self.decompressor.unconsumed_tail:
+            raise WebSocketError("Message too large")
+        return data
+
+    def receive(self):
+        """
+        Returns the next text message from the client, answering pings along the way.
+        Returns None once the client has closed the connection.
+        Raises WebSocketError on protocol violations and UnicodeDecodeError if a text message is not valid UTF-8.
+        """
+        fragments = []
+        compressed = False
+        while True:
+            fin, rsv1, opcode, payload = self._read_frame()
+            if opcode == OPCODE_CLOSE:
+                self.close()
+                return None
+            if opcode == OPCODE_PING:
+                self.send_frame(encode_frame(payload, OPCODE_PONG))
+                continue
+            if opcode == OPCODE_PONG:
+                continue
+            if opcode in (OPCODE_TEXT, OPCODE_BINARY):
+                if fragments:
+                    raise WebSocketError("New message started before the previous one finished")
+                if rsv1 and not self.deflate:
+                    raise WebSocketError("Compressed frame without negotiated permessage-deflate")
+                compressed = rsv1
+            elif opcode != OPCODE_CONTINUATION or not fragments:
+                raise WebSocketError(f"Unexpected opcode {opcode}")
+            fragments.append(payload)
+            if sum(len(fragment) for fragment in fragments) > MAX_MESSAGE_SIZE:
+                raise WebSocketError("Message too large")
+            if fin:
+                break
+        data = b"".join(fragments)
+        if compressed:
+            data = self._inflate(data)
+        return data.decode('utf-8')